@@ -1,20 +1,46 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
+from starlette.background import BackgroundTask
 from typing import List, Optional
 import cv2
 import numpy as np
-from deepface import DeepFace
+from numba import njit, prange
+from turbojpeg import TurboJPEG
 from PIL import Image
 import io
+import base64
+import json
+import uuid
 import tempfile
 import os
-from datetime import datetime, timedelta
-from collections import defaultdict
+import re
+from urllib.parse import quote
+from datetime import date, datetime, timedelta
 import asyncio
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fractions import Fraction
+from functools import lru_cache
+import av
+from av.codec.hwaccel import HWAccel
+import redis.asyncio as aioredis
+from blake3 import blake3
+
+from retinaface.commons import postprocess, weight_utils
+from retinaface.model import retinaface_onnx_model
+import onnxruntime as ort
+from onnxruntime.quantization import quantize_dynamic, QuantType
 
 app = FastAPI(title="Face Anonymizer API", version="1.0.0")
 
+# Let OpenCV use its SIMD and multithreaded code paths for blur/resize
+cv2.setUseOptimized(True)
+cv2.setNumThreads(os.cpu_count() or 1)
+
 # CORS configuration
 app.add_middleware(
     CORSMiddleware,
@@ -24,157 +50,786 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Rate limiting storage (in production, use Redis)
-rate_limit_storage = defaultdict(list)
+# Rate limiting counters live in Redis so they are shared across workers
+redis = aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
 RATE_LIMIT = 5  # 5 requests per day per IP
 RATE_LIMIT_WINDOW = timedelta(days=1)
 
-def check_rate_limit(ip_address: str) -> bool:
+def _rate_limit_key(ip_address: str) -> str:
+    return f"rl:{ip_address}:{date.today().isoformat()}"
+
+async def check_rate_limit(ip_address: str) -> bool:
     """Check if IP has exceeded rate limit"""
-    now = datetime.now()
-    # Clean old entries
-    rate_limit_storage[ip_address] = [
-        timestamp for timestamp in rate_limit_storage[ip_address]
-        if now - timestamp < RATE_LIMIT_WINDOW
-    ]
-    
-    # Check if limit exceeded
-    if len(rate_limit_storage[ip_address]) >= RATE_LIMIT:
-        return False
-    
-    # Add current request
-    rate_limit_storage[ip_address].append(now)
-    return True
+    key = _rate_limit_key(ip_address)
+    # Create the counter with its TTL and increment it in one round trip, so
+    # a failure between the two can never leave a key without expiry
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.set(key, 0, ex=int(RATE_LIMIT_WINDOW.total_seconds()), nx=True)
+        pipe.incr(key)
+        _, count = await pipe.execute()
+    return count <= RATE_LIMIT
 
-def get_remaining_uses(ip_address: str) -> dict:
+async def get_remaining_uses(ip_address: str) -> dict:
     """Get remaining uses for an IP"""
-    now = datetime.now()
-    rate_limit_storage[ip_address] = [
-        timestamp for timestamp in rate_limit_storage[ip_address]
-        if now - timestamp < RATE_LIMIT_WINDOW
-    ]
-    used = len(rate_limit_storage[ip_address])
+    count = await redis.get(_rate_limit_key(ip_address))
+    used = min(int(count or 0), RATE_LIMIT)
     remaining = max(0, RATE_LIMIT - used)
     return {"used": used, "remaining": remaining, "limit": RATE_LIMIT}
 
-def detect_faces_deepface(image_array):
-    """Detect faces using DeepFace with RetinaFace backend"""
+# Processed results are cached by upload content hash so repeated uploads
+# skip detection entirely
+RESULT_CACHE_TTL = 86400
+VIDEO_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Larger videos are streamed but not cached
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+def result_cache_key(digest: str, *params) -> str:
+    return ":".join(["anon", digest, *map(str, params)])
+
+async def get_cached_result(key: str) -> Optional[dict]:
+    """Return the cached result fields for a key, or None on a miss"""
+    cached = await redis.hgetall(key)
+    if not cached:
+        return None
+    return {field.decode(): value for field, value in cached.items()}
+
+async def cache_result(key: str, data: bytes, **fields):
+    """Store a processed result together with its response metadata"""
+    mapping = {"data": data, **{name: str(value) for name, value in fields.items()}}
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, RESULT_CACHE_TTL)
+        await pipe.execute()
+
+JPEG_QUALITY = 85
+
+# libjpeg-turbo handle for JPEG transcode; OpenCV covers other formats and
+# hosts where the shared library is missing
+try:
+    tj = TurboJPEG()
+except Exception as e:
+    print(f"libjpeg-turbo unavailable, using OpenCV JPEG codec: {e}")
+    tj = None
+
+# Transforms that bring an image stored with a given EXIF orientation upright
+EXIF_ORIENTATION_TAG = 0x0112
+_EXIF_ORIENTATION_TRANSFORMS = {
+    2: lambda image: cv2.flip(image, 1),
+    3: lambda image: cv2.rotate(image, cv2.ROTATE_180),
+    4: lambda image: cv2.flip(image, 0),
+    5: cv2.transpose,
+    6: lambda image: cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE),
+    7: lambda image: cv2.flip(cv2.transpose(image), -1),
+    8: lambda image: cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE),
+}
+
+def _exif_orientation(contents):
+    """EXIF orientation of an encoded image, read from its header only"""
     try:
-        # DeepFace expects BGR format (OpenCV default)
-        faces = DeepFace.extract_faces(
-            img_path=image_array,
-            detector_backend='retinaface',
-            enforce_detection=False,
-            align=False
-        )
+        with Image.open(io.BytesIO(contents)) as img:
+            return img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    except Exception:
+        return 1
+
+def decode_image(contents, keep_alpha=False):
+    """Decode uploaded bytes into an upright BGR image, or None if unreadable
+    
+    With `keep_alpha`, 8-bit images with an alpha channel decode to BGRA.
+    """
+    if not contents:
+        # cv2.imdecode raises on an empty buffer instead of returning None
+        return None
+    if tj is not None and contents[:3] == b'\xff\xd8\xff':
+        try:
+            image = tj.decode(contents)
+        except Exception:
+            image = None
+        if image is not None:
+            # TurboJPEG ignores EXIF orientation, which cv2.imdecode applies
+            transform = _EXIF_ORIENTATION_TRANSFORMS.get(_exif_orientation(contents))
+            return image if transform is None else transform(image)
+    nparr = np.frombuffer(contents, np.uint8)
+    if keep_alpha:
+        image = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+        # Grayscale and 16-bit images still go through the BGR decode below
+        if image is not None and image.dtype == np.uint8 and image.ndim == 3:
+            return image
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+def encode_jpeg(image):
+    """Encode a BGR image to JPEG bytes"""
+    if tj is not None:
+        return tj.encode(image, quality=JPEG_QUALITY)
+    _, buffer = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+    return buffer.tobytes()
+
+# Output formats of the image endpoint: media type and file extension
+IMAGE_OUTPUT_FORMATS = {
+    'jpeg': ('image/jpeg', '.jpg'),
+    'png': ('image/png', '.png'),
+}
+PNG_COMPRESSION = 1  # Fast zlib level; PNG output stays lossless either way
+# JPEG output of the image endpoint: a higher quality with optimized Huffman
+# tables, limiting generational loss when the upload was already a JPEG
+IMAGE_JPEG_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), 90, int(cv2.IMWRITE_JPEG_OPTIMIZE), 1]
+
+def sniff_output_format(contents):
+    """Keep PNG uploads lossless; everything else is returned as JPEG"""
+    if contents[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    return 'jpeg'
+
+def encode_image(image, output_format='jpeg'):
+    """Encode a BGR (or, for PNG, BGRA) image in one of IMAGE_OUTPUT_FORMATS"""
+    if output_format == 'png':
+        _, buffer = cv2.imencode('.png', image, [int(cv2.IMWRITE_PNG_COMPRESSION), PNG_COMPRESSION])
+    else:
+        _, buffer = cv2.imencode('.jpg', image, IMAGE_JPEG_PARAMS)
+    return buffer.tobytes()
+
+# Detection is serialized within a process so ONNX Runtime's intra-op thread
+# pool owns its cores
+_detector_lock = threading.Lock()
+
+# Set RETINAFACE_INT8=1 to serve a dynamically int8-quantized copy of the model
+RETINAFACE_INT8 = os.getenv("RETINAFACE_INT8", "0") == "1"
+RETINAFACE_THRESHOLD = 0.9
+DETECTOR_THREADS = os.cpu_count() or 1
+
+def _retinaface_model_path():
+    """Path of the RetinaFace ONNX weights, quantizing them once if requested"""
+    fp32_path = weight_utils.download_weights_if_necessary(
+        file_name="retinaface.onnx", source_urls=retinaface_onnx_model.WEIGHTS_URLS
+    )
+    if not RETINAFACE_INT8:
+        return fp32_path
+    
+    int8_path = fp32_path.replace(".onnx", "_int8.onnx")
+    if not os.path.exists(int8_path):
+        # Pool workers may quantize concurrently: each writes its own file and
+        # atomically renames it, so no worker ever loads a partial model
+        tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+        try:
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, int8_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    return int8_path
+
+@lru_cache(maxsize=None)
+def get_face_detector():
+    """Return the RetinaFace ONNX Runtime model, building it on first use"""
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = DETECTOR_THREADS
+    options.log_severity_level = 3
+    # Prefer the GPU when onnxruntime-gpu is installed
+    available = ort.get_available_providers()
+    providers = [
+        provider for provider in ['CUDAExecutionProvider', 'CPUExecutionProvider']
+        if provider in available
+    ]
+    session = ort.InferenceSession(
+        _retinaface_model_path(), sess_options=options, providers=providers
+    )
+    # ONNX Runtime silently drops CUDA when its CUDA/cuDNN libraries are missing
+    active = session.get_providers()
+    if 'CUDAExecutionProvider' in providers and 'CUDAExecutionProvider' not in active:
+        print("onnxruntime-gpu could not initialise CUDA, RetinaFace runs on the CPU")
+    print(f"RetinaFace running on {active[0]}")
+    return retinaface_onnx_model.RetinaFace(session)
+
+# Longest side of the copy detection runs on; boxes are mapped back to full size
+DETECTION_MAX_SIDE = 720
+
+# Upper bound on images per RetinaFace call, keeping the input tensor small
+DETECTION_BATCH_SIZE = 8
+
+def detect_faces_retinaface(image_array):
+    """Detect faces using RetinaFace on ONNX Runtime"""
+    return detect_faces_batch([image_array])[0]
+
+def detect_faces_batch(images, max_side=DETECTION_MAX_SIDE):
+    """Detect faces in several images with one RetinaFace call per batch
+    
+    Detection runs on copies downscaled to `max_side`, since RetinaFace
+    cost grows with pixel count; returned boxes are in the coordinates of
+    each full-resolution image.
+    """
+    scales = []
+    smalls = []
+    for image in images:
+        scale = min(1.0, max_side / max(image.shape[:2]))
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        scales.append(scale)
+        smalls.append(image)
+    
+    results = []
+    for start in range(0, len(smalls), DETECTION_BATCH_SIZE):
+        results.extend(_detect_faces_batch(smalls[start:start + DETECTION_BATCH_SIZE]))
+    
+    return [
+        [
+            (round(x / scale), round(y / scale), round(w / scale), round(h / scale))
+            for (x, y, w, h) in faces
+        ]
+        for faces, scale in zip(results, scales)
+    ]
+
+# RetinaFace anchors per feature stride, as in RetinaFace.detect_faces
+_RETINAFACE_ANCHORS = {
+    32: np.array([[-248.0, -248.0, 263.0, 263.0], [-120.0, -120.0, 135.0, 135.0]], dtype=np.float32),
+    16: np.array([[-56.0, -56.0, 71.0, 71.0], [-24.0, -24.0, 39.0, 39.0]], dtype=np.float32),
+    8: np.array([[-8.0, -8.0, 23.0, 23.0], [0.0, 0.0, 15.0, 15.0]], dtype=np.float32),
+}
+RETINAFACE_NMS_THRESHOLD = 0.4
+
+def _detect_faces_batch(images):
+    """Run RetinaFace once over `images`, falling back to Haar cascades on error
+    
+    The images are letterboxed into one (N, H, W, 3) tensor, padded at the
+    bottom and right so box coordinates need no offset, and the outputs are
+    decoded per image.
+    """
+    try:
+        height = max(image.shape[0] for image in images)
+        width = max(image.shape[1] for image in images)
+        # RetinaFace takes RGB floats; our images are BGR
+        batch = np.zeros((len(images), height, width, 3), dtype=np.float32)
+        for i, image in enumerate(images):
+            batch[i, :image.shape[0], :image.shape[1]] = image[:, :, ::-1]
+        
+        with _detector_lock:
+            net_out = get_face_detector()(batch)
         
-        face_locations = []
-        for face in faces:
-            facial_area = face.get('facial_area', {})
-            if facial_area:
-                x = facial_area.get('x', 0)
-                y = facial_area.get('y', 0)
-                w = facial_area.get('w', 0)
-                h = facial_area.get('h', 0)
-                face_locations.append((x, y, w, h))
+        # Outputs come as (scores, box deltas, landmarks) per stride; anchors
+        # depend only on the feature map size, so they are shared by the batch
+        anchors = []
+        for level, stride in enumerate(_RETINAFACE_ANCHORS):
+            feature_height, feature_width = net_out[3 * level + 1].shape[1:3]
+            anchors.append(postprocess.anchors_plane(
+                feature_height, feature_width, stride, _RETINAFACE_ANCHORS[stride]
+            ).reshape(-1, 4))
         
-        return face_locations
+        return [
+            _decode_retinaface(net_out, anchors, i, image.shape[:2])
+            for i, image in enumerate(images)
+        ]
     except Exception as e:
-        print(f"DeepFace detection error: {e}")
+        print(f"RetinaFace detection error: {e}")
         # Fallback to OpenCV Haar Cascade
-        return detect_faces_opencv(image_array)
+        return [detect_faces_opencv(image) for image in images]
+
+def _decode_retinaface(net_out, anchors, index, image_shape):
+    """Decode image `index` of a batched RetinaFace output into (x, y, w, h) boxes"""
+    proposals_list = []
+    for level, stride in enumerate(_RETINAFACE_ANCHORS):
+        num_anchors = len(_RETINAFACE_ANCHORS[stride])
+        scores = net_out[3 * level][index, :, :, num_anchors:].reshape(-1)
+        bbox_deltas = net_out[3 * level + 1][index].reshape(-1, 4)
+        
+        # Only decode anchors that pass the score threshold
+        order = np.where(scores >= RETINAFACE_THRESHOLD)[0]
+        proposals = postprocess.bbox_pred(anchors[level][order], bbox_deltas[order])
+        proposals = postprocess.clip_boxes(proposals, image_shape)
+        proposals_list.append(np.hstack((proposals, scores[order, np.newaxis])))
+    
+    dets = np.vstack(proposals_list).astype(np.float32, copy=False)
+    if dets.shape[0] == 0:
+        return []
+    
+    face_locations = []
+    for x1, y1, x2, y2, _ in dets[postprocess.cpu_nms(dets, RETINAFACE_NMS_THRESHOLD)]:
+        x, y = int(x1), int(y1)
+        w, h = int(x2) - x, int(y2) - y
+        if w > 0 and h > 0:
+            face_locations.append((x, y, w, h))
+    
+    return face_locations
+
+# Inputs whose longest side exceeds this are detected tile by tile
+TILED_DETECTION_MIN_SIDE = 2048
+TILE_NMS_THRESHOLD = 0.3
+
+def _tile_spans(length, max_tile, overlap):
+    """Evenly spread (start, size) spans covering [0, length)
+    
+    Tiles are at most `max_tile` long and overlap by at least `overlap`;
+    spreading them evenly avoids a last tile that mostly repeats its
+    neighbour.
+    """
+    if length <= max_tile:
+        return [(0, length)]
+    count = -(-(length - overlap) // (max_tile - overlap))
+    size = -(-(length + (count - 1) * overlap) // count)
+    step = (length - size) / (count - 1)
+    return [(round(i * step), size) for i in range(count)]
+
+def detect_faces_tiled(image_array, tile=1024, overlap=128):
+    """Detect faces on very large images from a whole-image pass plus tiles
+    
+    The downscaled whole-image pass finds large faces and faces cut by tile
+    seams; the tiles run at full resolution (no DETECTION_MAX_SIDE
+    downscale) and keep the small faces that downscaling would lose. That
+    costs roughly the image's own pixel count: a 4K still runs the 720 px
+    pass plus 15 tiles of 871x806, about 11 MP of inference instead of 0.3.
+    """
+    height, width = image_array.shape[:2]
+    boxes = [list(box) for box in detect_faces_retinaface(image_array)]
+    
+    offsets = []
+    tiles = []
+    for y0, tile_height in _tile_spans(height, tile, overlap):
+        for x0, tile_width in _tile_spans(width, tile, overlap):
+            offsets.append((x0, y0))
+            tiles.append(image_array[y0:y0 + tile_height, x0:x0 + tile_width])
+    
+    for (x0, y0), faces in zip(offsets, detect_faces_batch(tiles, max_side=tile)):
+        for (x, y, w, h) in faces:
+            boxes.append([int(x) + x0, int(y) + y0, int(w), int(h)])
+    
+    if not boxes:
+        return []
+    
+    # Merge duplicates across tiles and the whole-image pass, preferring
+    # larger boxes so a face cut by a tile edge keeps its full box
+    scores = [float(w * h) for (_, _, w, h) in boxes]
+    keep = cv2.dnn.NMSBoxes(boxes, scores, 0.0, TILE_NMS_THRESHOLD)
+    return [tuple(boxes[i]) for i in np.array(keep).flatten()]
+
+def detect_faces(image_array):
+    """Detect faces in a still image, tiling very large inputs
+    
+    Video frames use detect_faces_retinaface directly: tiling every
+    keyframe would multiply the per-frame cost for faces that the
+    trackers and the next keyframe cover anyway.
+    """
+    if max(image_array.shape[:2]) > TILED_DETECTION_MIN_SIDE:
+        return detect_faces_tiled(image_array)
+    return detect_faces_retinaface(image_array)
+
+# Haar cascade for the fallback detector, parsed once at startup
+_FACE_CASCADE = cv2.CascadeClassifier(
+    cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+)
 
 def detect_faces_opencv(image_array):
     """Fallback face detection using OpenCV Haar Cascade"""
     try:
         gray = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
-        face_cascade = cv2.CascadeClassifier(
-            cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-        )
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+        faces = _FACE_CASCADE.detectMultiScale(gray, 1.3, 5)
         return [(x, y, w, h) for (x, y, w, h) in faces]
     except Exception as e:
         print(f"OpenCV detection error: {e}")
         return []
 
 def anonymize_face(image, x, y, w, h, method='blur', intensity=51):
-    """Apply anonymization to a detected face region"""
-    # Extract face region
+    """Apply anonymization to a detected face region, in place"""
+    # Extract face region (a view, written back through `dst`)
     face_region = image[y:y+h, x:x+w]
+    h, w = face_region.shape[:2]
     
     if method == 'blur':
         # Gaussian blur
         kernel_size = intensity if intensity % 2 == 1 else intensity + 1
-        anonymized = cv2.GaussianBlur(face_region, (kernel_size, kernel_size), 0)
+        cv2.GaussianBlur(face_region, (kernel_size, kernel_size), 0, dst=face_region)
     
     elif method == 'pixelate':
-        # Pixelation effect
-        small_face = cv2.resize(face_region, (w // intensity, h // intensity), 
-                                interpolation=cv2.INTER_LINEAR)
-        anonymized = cv2.resize(small_face, (w, h), interpolation=cv2.INTER_NEAREST)
+        # Pixelation effect, shared with the batched path in anonymize_faces
+        anonymize_boxes(
+            image, np.array([[x, y, w, h]], dtype=np.int32),
+            METHOD_CODES['pixelate'], max(1, intensity)
+        )
     
     elif method == 'mask':
         # Black rectangle mask
-        anonymized = np.zeros_like(face_region)
-    
-    else:
-        anonymized = face_region
+        face_region[:] = 0
     
-    # Replace face region in original image
-    image[y:y+h, x:x+w] = anonymized
     return image
 
+# MOSSE trackers come from opencv-contrib; without them every frame is detected
+TRACKERS_AVAILABLE = hasattr(cv2, 'legacy')
+if not TRACKERS_AVAILABLE:
+    print("cv2.legacy trackers unavailable (install opencv-contrib), "
+          "video faces will be detected on every frame")
+
+def create_face_trackers(frame, face_locations):
+    """Initialise a MOSSE tracker per detected face, or None without tracker support"""
+    if not TRACKERS_AVAILABLE:
+        return None
+    trackers = cv2.legacy.MultiTracker_create()
+    for (x, y, w, h) in face_locations:
+        trackers.add(cv2.legacy.TrackerMOSSE_create(), frame, (x, y, w, h))
+    return trackers
+
+def update_face_trackers(trackers, frame):
+    """Propagate face boxes to the current frame, clipped to frame bounds
+    
+    Returns None when any face was lost, so the caller re-detects instead of
+    leaving a moving face exposed behind a stale box.
+    """
+    ok, boxes = trackers.update(frame)
+    if not ok:
+        return None
+    
+    frame_h, frame_w = frame.shape[:2]
+    tracked = []
+    for (x, y, w, h) in boxes:
+        x0, y0 = max(0, int(x)), max(0, int(y))
+        x1, y1 = min(frame_w, int(x + w)), min(frame_h, int(y + h))
+        if x1 > x0 and y1 > y0:
+            tracked.append((x0, y0, x1 - x0, y1 - y0))
+    return tracked
+
+# Method codes understood by the compiled anonymize_boxes kernel
+METHOD_CODES = {'pixelate': 1, 'mask': 2}
+
+@njit(parallel=True, cache=True)
+def anonymize_boxes(img, boxes, method_code, intensity):
+    """Pixelate or mask all face boxes of an image in one native call
+    
+    Boxes may overlap, so they are handled one after another; the parallel
+    loop runs over the block rows of a box, which never share pixels.
+    """
+    img_h, img_w = img.shape[0], img.shape[1]
+    channels = img.shape[2]
+    for b in range(boxes.shape[0]):
+        x0 = max(boxes[b, 0], 0)
+        y0 = max(boxes[b, 1], 0)
+        x1 = min(boxes[b, 0] + boxes[b, 2], img_w)
+        y1 = min(boxes[b, 1] + boxes[b, 3], img_h)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        
+        if method_code == 2:
+            # Black rectangle mask
+            img[y0:y1, x0:x1] = 0
+            continue
+        
+        # Pixelation: replace each intensity x intensity block by its mean
+        for row in prange((y1 - y0 + intensity - 1) // intensity):
+            by = y0 + row * intensity
+            ey = min(by + intensity, y1)
+            for bx in range(x0, x1, intensity):
+                ex = min(bx + intensity, x1)
+                n = (ey - by) * (ex - bx)
+                for c in range(channels):
+                    acc = 0
+                    for yy in range(by, ey):
+                        for xx in range(bx, ex):
+                            acc += img[yy, xx, c]
+                    value = acc // n
+                    for yy in range(by, ey):
+                        for xx in range(bx, ex):
+                            img[yy, xx, c] = value
+    return img
+
+def anonymize_faces(image_array, face_locations, method='blur', intensity=51):
+    """Apply anonymization to every face region already located in an image"""
+    if len(face_locations) == 0:
+        return image_array
+    
+    method_code = METHOD_CODES.get(method)
+    if method_code is None:
+        # Gaussian blur stays on OpenCV's optimized kernel, one call per face
+        for (x, y, w, h) in face_locations:
+            image_array = anonymize_face(image_array, x, y, w, h, method, intensity)
+        return image_array
+    
+    boxes = np.asarray(face_locations, dtype=np.int32).reshape(-1, 4)
+    return anonymize_boxes(image_array, boxes, method_code, max(1, intensity))
+
 def process_image(image_array, method='blur', intensity=51):
     """Process a single image to detect and anonymize faces"""
     # Detect faces
-    face_locations = detect_faces_deepface(image_array)
+    face_locations = detect_faces(image_array)
     
     # Apply anonymization to each face
-    for (x, y, w, h) in face_locations:
-        image_array = anonymize_face(image_array, x, y, w, h, method, intensity)
+    image_array = anonymize_faces(image_array, face_locations, method, intensity)
     
     return image_array, len(face_locations)
 
-def process_video(video_path, output_path, method='blur', intensity=51):
-    """Process video to detect and anonymize faces in all frames"""
-    cap = cv2.VideoCapture(video_path)
+def process_images(images, method='blur', intensity=51):
+    """Process several images, detecting faces in one batched call
+    
+    Returns a list of (image, faces_count). Images large enough for tiled
+    detection are detected on their own.
+    """
+    batchable = [image for image in images if max(image.shape[:2]) <= TILED_DETECTION_MIN_SIDE]
+    batched_faces = iter(detect_faces_batch(batchable))
+    
+    results = []
+    for image in images:
+        if max(image.shape[:2]) <= TILED_DETECTION_MIN_SIDE:
+            face_locations = next(batched_faces)
+        else:
+            face_locations = detect_faces(image)
+        results.append((anonymize_faces(image, face_locations, method, intensity), len(face_locations)))
+    
+    return results
+
+VIDEO_PREFETCH = 8  # Frames buffered between decode, process and encode stages
+
+def _put_until_stopped(q, item, stop_event):
+    """Block on a bounded queue, but give up once the consumer has stopped"""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+def _get_until_stopped(q, stop_event):
+    """Block on a queue, returning None once the producer side has failed"""
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+# Hardware decoders tried in order before falling back to software decode
+VIDEO_HWACCEL_DEVICES = ['cuda', 'vaapi', 'videotoolbox']
+
+# Encoders tried in order: NVENC, VAAPI, VideoToolbox, then software codecs
+VIDEO_ENCODERS = ['h264_nvenc', 'h264_vaapi', 'h264_videotoolbox', 'libx264', 'mpeg4']
+
+def open_video_input(video_path):
+    """Open a video for decoding, using the first available hardware decoder"""
+    for device_type in VIDEO_HWACCEL_DEVICES:
+        try:
+            return av.open(
+                video_path,
+                hwaccel=HWAccel(device_type=device_type, allow_software_fallback=True)
+            )
+        except Exception:
+            continue
+    return av.open(video_path)
+
+@lru_cache(maxsize=None)
+def select_video_encoder():
+    """Return the first encoder in VIDEO_ENCODERS that opens on this host"""
+    for codec_name in VIDEO_ENCODERS:
+        try:
+            ctx = av.CodecContext.create(codec_name, 'w')
+            ctx.width = 256
+            ctx.height = 256
+            ctx.pix_fmt = 'yuv420p'
+            ctx.time_base = Fraction(1, 30)
+            ctx.open()
+            return codec_name
+        except Exception:
+            continue
+    raise RuntimeError("No usable video encoder found")
+
+def _read_frames(container, stream, read_q, stop_event, errors):
+    """Reader stage: decode frames into the queue until EOF
+    
+    Decode errors are recorded in `errors` so the video is not returned
+    truncated as if it had ended.
+    """
+    try:
+        for frame in container.decode(stream):
+            if stop_event.is_set():
+                break
+            image = frame.to_ndarray(format='bgr24')
+            if frame.rotation:
+                # Apply the display matrix (e.g. portrait phone videos) so faces
+                # are upright for detection and the output needs no rotation
+                image = np.ascontiguousarray(np.rot90(image, round(frame.rotation / 90)))
+            _put_until_stopped(read_q, image, stop_event)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        _put_until_stopped(read_q, None, stop_event)
+
+def _write_frames(out, stream, write_q, writer_failed, errors):
+    """Writer stage: encode processed frames until the sentinel arrives
+    
+    On an encode/mux error the exception is recorded and `writer_failed`
+    is set, so the producer stops instead of blocking on a full queue.
+    """
+    try:
+        while True:
+            frame = write_q.get()
+            if frame is None:
+                break
+            video_frame = av.VideoFrame.from_ndarray(frame, format='bgr24')
+            for packet in stream.encode(video_frame):
+                out.mux(packet)
+        
+        # Flush delayed packets from the encoder
+        for packet in stream.encode():
+            out.mux(packet)
+    except Exception as e:
+        errors.append(e)
+        writer_failed.set()
+
+def process_video(video_path, output_path, method='blur', intensity=51, detect_interval=15):
+    """Process video to detect and anonymize faces in all frames
+    
+    Full face detection only runs every `detect_interval` frames; boxes are
+    propagated to the frames in between with lightweight trackers, falling
+    back to detection whenever a tracker loses its face.
+    """
+    container = open_video_input(video_path)
+    in_stream = container.streams.video[0]
+    in_stream.thread_type = 'AUTO'
     
     # Get video properties
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = in_stream.average_rate or Fraction(30)
+    total_frames = in_stream.frames
     
-    # Define codec and create VideoWriter
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+    # Create output container with a hardware encoder when available; its
+    # size is set from the first (upright) frame
+    out = av.open(output_path, 'w')
+    out_stream = out.add_stream(select_video_encoder(), rate=fps)
+    out_stream.pix_fmt = 'yuv420p'
     
     frame_count = 0
     total_faces = 0
+    trackers = None
     
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-        
-        # Process frame
-        processed_frame, faces_count = process_image(frame.copy(), method, intensity)
-        total_faces += faces_count
-        
-        # Write processed frame
-        out.write(processed_frame)
-        frame_count += 1
-        
-        # Progress tracking (could be sent via websocket in production)
-        if frame_count % 10 == 0:
-            progress = (frame_count / total_frames) * 100
-            print(f"Processing: {progress:.1f}% - Frame {frame_count}/{total_frames}")
+    # Decode and encode run on their own threads so codec I/O overlaps with
+    # detection; detection itself stays on this thread
+    read_q = queue.Queue(maxsize=VIDEO_PREFETCH)
+    write_q = queue.Queue(maxsize=VIDEO_PREFETCH)
+    stop_event = threading.Event()
+    writer_failed = threading.Event()
+    errors = []
+    reader = threading.Thread(
+        target=_read_frames, args=(container, in_stream, read_q, stop_event, errors), daemon=True
+    )
+    writer = threading.Thread(
+        target=_write_frames, args=(out, out_stream, write_q, writer_failed, errors), daemon=True
+    )
+    reader.start()
+    writer.start()
+    
+    try:
+        while True:
+            frame = _get_until_stopped(read_q, writer_failed)
+            if frame is None:
+                break
+            
+            if frame_count == 0:
+                # yuv420p needs even dimensions; the encoder rescales frames to
+                # fit. The writer only opens the codec once this frame arrives.
+                height, width = frame.shape[:2]
+                out_stream.width = width - width % 2
+                out_stream.height = height - height % 2
+            
+            # Detect on keyframes, track in between; re-detect when tracking
+            # is unavailable or loses a face
+            face_locations = None
+            if frame_count % detect_interval != 0 and trackers is not None:
+                face_locations = update_face_trackers(trackers, frame)
+            if face_locations is None:
+                face_locations = detect_faces_retinaface(frame)
+                trackers = create_face_trackers(frame, face_locations)
+            
+            # Process frame
+            # Decoded frames are freshly allocated, so anonymize in place
+            processed_frame = anonymize_faces(frame, face_locations, method, intensity)
+            total_faces += len(face_locations)
+            
+            # Hand processed frame to the writer
+            _put_until_stopped(write_q, processed_frame, writer_failed)
+            frame_count += 1
+            
+            # Progress tracking (could be sent via websocket in production)
+            if frame_count % 10 == 0 and total_frames:
+                progress = (frame_count / total_frames) * 100
+                print(f"Processing: {progress:.1f}% - Frame {frame_count}/{total_frames}")
+    finally:
+        stop_event.set()
+        _put_until_stopped(write_q, None, writer_failed)
+        reader.join()
+        writer.join()
+        container.close()
+        out.close()
     
-    cap.release()
-    out.release()
+    # Surface decode/encode failures instead of returning a partial video
+    if errors:
+        raise errors[0]
     
     return total_faces, frame_count
 
+# CPU-bound work runs in a process pool so the event loop stays free. Each of
+# the WEB_CONCURRENCY uvicorn workers gets its share of the cores.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "4"))
+PROCESS_POOL_WORKERS = max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+
+def warm_up_detector():
+    """Load RetinaFace and run one inference so the first request is warm"""
+    get_face_detector()(np.zeros((1, 320, 320, 3), dtype=np.float32))
+
+def _init_pool_worker():
+    """Process pool initializer: load the detector inside each worker
+    
+    Workers are spawned rather than forked, and the model is built here
+    instead of at parent import, so no ONNX Runtime state crosses a fork.
+    """
+    global DETECTOR_THREADS
+    # One thread per worker process; the pool provides the parallelism
+    DETECTOR_THREADS = 1
+    cv2.setNumThreads(1)
+    # An initializer that raises breaks the whole pool; without a detector
+    # requests still work through the Haar cascade fallback
+    try:
+        warm_up_detector()
+    except Exception as e:
+        print(f"RetinaFace warm-up failed, falling back to Haar cascades: {e}")
+    # Compile (or load from cache) the anonymize_boxes kernel up front
+    anonymize_boxes(
+        np.zeros((8, 8, 3), dtype=np.uint8), np.array([[0, 0, 8, 8]], dtype=np.int32),
+        METHOD_CODES['pixelate'], 4
+    )
+
+def _pool_worker_ready():
+    return True
+
+def _create_executor():
+    return ProcessPoolExecutor(
+        max_workers=PROCESS_POOL_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_pool_worker
+    )
+
+executor = _create_executor()
+
+async def run_in_pool(func, *args):
+    """Run a CPU-bound function in the process pool
+    
+    A worker that dies (e.g. OOM-killed) breaks the whole executor, so a
+    broken pool is replaced and the call retried once; a second failure is
+    raised, leaving a fresh pool for later requests.
+    """
+    global executor
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = executor
+        try:
+            return await loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool:
+            # Concurrent calls fail together; only the first one rebuilds
+            if executor is pool:
+                print("Process pool worker died, restarting the pool")
+                executor = _create_executor()
+                pool.shutdown(wait=False, cancel_futures=True)
+            if attempt == 1:
+                raise
+
+@app.on_event("startup")
+async def start_process_pool():
+    """Spawn the pool workers up front so their detectors load before requests"""
+    await asyncio.gather(*[run_in_pool(_pool_worker_ready) for _ in range(PROCESS_POOL_WORKERS)])
+
+@app.on_event("shutdown")
+async def stop_process_pool():
+    executor.shutdown(wait=False, cancel_futures=True)
+
 @app.get("/")
 async def root():
     return {
@@ -197,9 +852,20 @@ async def health_check():
 async def get_rate_limit(request: Request):
     """Get rate limit info for the requesting IP"""
     client_ip = request.client.host
-    usage = get_remaining_uses(client_ip)
+    usage = await get_remaining_uses(client_ip)
     return usage
 
+def content_disposition(filename):
+    """Content-Disposition value for an anonymized upload, safe for any filename
+    
+    Upload names are client-controlled, so the plain `filename` gets an ASCII
+    fallback without quotes, backslashes or control characters, and the
+    original name is carried RFC 2231-encoded in `filename*`.
+    """
+    name = f"anonymized_{filename or 'file'}"
+    fallback = re.sub(r'[^\x20-\x7e]|["\\]', '_', name)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name, safe='')}"
+
 @app.post("/api/anonymize/image")
 async def anonymize_image_endpoint(
     request: Request,
@@ -210,8 +876,8 @@ async def anonymize_image_endpoint(
     """Anonymize faces in a single image"""
     # Check rate limit
     client_ip = request.client.host
-    if not check_rate_limit(client_ip):
-        usage = get_remaining_uses(client_ip)
+    if not await check_rate_limit(client_ip):
+        usage = await get_remaining_uses(client_ip)
         raise HTTPException(
             status_code=429,
             detail=f"Rate limit exceeded. You have used {usage['used']}/{usage['limit']} requests today."
@@ -224,29 +890,40 @@ async def anonymize_image_endpoint(
     try:
         # Read image
         contents = await file.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            raise HTTPException(status_code=400, detail="Invalid image file")
+        output_format = sniff_output_format(contents)
+        media_type, extension = IMAGE_OUTPUT_FORMATS[output_format]
+        cache_key = result_cache_key(
+            blake3(contents).hexdigest(), "image", output_format, method, intensity
+        )
+        cached = await get_cached_result(cache_key)
         
-        # Process image
-        processed_image, faces_count = process_image(image, method, intensity)
+        if cached:
+            image_bytes = cached["data"]
+            faces_count = int(cached["faces"])
+        else:
+            # Decode, process and encode in the process pool
+            image_bytes, faces_count = await run_in_pool(
+                anonymize_image_bytes, contents, method, intensity, output_format
+            )
+            
+            if image_bytes is None:
+                raise HTTPException(status_code=400, detail="Invalid image file")
+            
+            await cache_result(cache_key, image_bytes, faces=faces_count)
         
-        # Convert back to bytes
-        _, buffer = cv2.imencode('.jpg', processed_image)
-        io_buf = io.BytesIO(buffer)
+        io_buf = io.BytesIO(image_bytes)
+        filename = os.path.splitext(file.filename)[0] + extension
         
-        usage = get_remaining_uses(client_ip)
+        usage = await get_remaining_uses(client_ip)
         
         return StreamingResponse(
             io_buf,
-            media_type="image/jpeg",
+            media_type=media_type,
             headers={
                 "X-Faces-Detected": str(faces_count),
                 "X-Rate-Limit-Remaining": str(usage['remaining']),
                 "X-Rate-Limit-Used": str(usage['used']),
-                "Content-Disposition": f"attachment; filename=anonymized_{file.filename}"
+                "Content-Disposition": content_disposition(filename)
             }
         )
     
@@ -258,13 +935,14 @@ async def anonymize_video_endpoint(
     request: Request,
     file: UploadFile = File(...),
     method: str = 'blur',
-    intensity: int = 51
+    intensity: int = 51,
+    detect_interval: int = 15
 ):
     """Anonymize faces in a video"""
     # Check rate limit
     client_ip = request.client.host
-    if not check_rate_limit(client_ip):
-        usage = get_remaining_uses(client_ip)
+    if not await check_rate_limit(client_ip):
+        usage = await get_remaining_uses(client_ip)
         raise HTTPException(
             status_code=429,
             detail=f"Rate limit exceeded. You have used {usage['used']}/{usage['limit']} requests today."
@@ -274,15 +952,40 @@ async def anonymize_video_endpoint(
     if not file.content_type.startswith('video/'):
         raise HTTPException(status_code=400, detail="File must be a video")
     
-    temp_input = None
-    temp_output = None
+    if detect_interval < 1:
+        raise HTTPException(status_code=400, detail="detect_interval must be at least 1")
+    
+    temp_input_path = None
+    temp_output_path = None
     
     try:
-        # Save uploaded video to temporary file
+        # Stream uploaded video to a temporary file, hashing it on the way
+        hasher = blake3()
         with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_input:
-            contents = await file.read()
-            temp_input.write(contents)
             temp_input_path = temp_input.name
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                temp_input.write(chunk)
+        
+        cache_key = result_cache_key(
+            hasher.hexdigest(), "video", method, intensity, detect_interval
+        )
+        cached = await get_cached_result(cache_key)
+        
+        if cached:
+            usage = await get_remaining_uses(client_ip)
+            
+            return StreamingResponse(
+                io.BytesIO(cached["data"]),
+                media_type="video/mp4",
+                headers={
+                    "X-Faces-Detected": cached["faces"].decode(),
+                    "X-Frames-Processed": cached["frames"].decode(),
+                    "X-Rate-Limit-Remaining": str(usage['remaining']),
+                    "X-Rate-Limit-Used": str(usage['used']),
+                    "Content-Disposition": content_disposition(file.filename)
+                }
+            )
         
         # Create temporary output file
         temp_output = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4')
@@ -290,32 +993,36 @@ async def anonymize_video_endpoint(
         temp_output.close()
         
         # Process video
-        total_faces, frames_processed = process_video(
+        total_faces, frames_processed = await run_in_pool(
+            process_video,
             temp_input_path, 
             temp_output_path, 
             method, 
-            intensity
+            intensity,
+            detect_interval
         )
         
-        # Read processed video
-        with open(temp_output_path, 'rb') as f:
-            video_bytes = f.read()
-        
-        io_buf = io.BytesIO(video_bytes)
+        if os.path.getsize(temp_output_path) <= VIDEO_CACHE_MAX_BYTES:
+            with open(temp_output_path, 'rb') as f:
+                await cache_result(cache_key, f.read(), faces=total_faces, frames=frames_processed)
         
-        usage = get_remaining_uses(client_ip)
+        usage = await get_remaining_uses(client_ip)
         
-        return StreamingResponse(
-            io_buf,
+        # Stream the processed video from disk; the file is removed once sent
+        response = FileResponse(
+            temp_output_path,
             media_type="video/mp4",
             headers={
                 "X-Faces-Detected": str(total_faces),
                 "X-Frames-Processed": str(frames_processed),
                 "X-Rate-Limit-Remaining": str(usage['remaining']),
                 "X-Rate-Limit-Used": str(usage['used']),
-                "Content-Disposition": f"attachment; filename=anonymized_{file.filename}"
-            }
+                "Content-Disposition": content_disposition(file.filename)
+            },
+            background=BackgroundTask(os.unlink, temp_output_path)
         )
+        temp_output_path = None
+        return response
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -327,18 +1034,116 @@ async def anonymize_video_endpoint(
         if temp_output_path and os.path.exists(temp_output_path):
             os.unlink(temp_output_path)
 
+def anonymize_image_bytes(contents, method, intensity, output_format='jpeg'):
+    """Decode, anonymize and encode an upload in `output_format`
+    
+    Returns (encoded_bytes, faces_count), or (None, 0) if the image cannot be
+    decoded. Works on bytes so only compressed data crosses process boundaries.
+    """
+    # PNG output keeps the upload's transparency
+    image = decode_image(contents, keep_alpha=(output_format == 'png'))
+    
+    if image is None:
+        return None, 0
+    
+    if image.shape[2] == 4:
+        # Anonymize the colour channels; the alpha channel is left as uploaded
+        bgr, faces_count = process_image(np.ascontiguousarray(image[:, :, :3]), method, intensity)
+        image[:, :, :3] = bgr
+        return encode_image(image, output_format), faces_count
+    
+    # Process image
+    processed_image, faces_count = process_image(image, method, intensity)
+    
+    return encode_image(processed_image, output_format), faces_count
+
+_DATA_URL_PREFIX = b'data:image/jpeg;base64,'
+
+def _decode_upload(contents):
+    """decode_image for one batch upload, treating decoder errors as unreadable
+    
+    A bad file must only fail its own entry, not the rest of its group.
+    """
+    try:
+        return decode_image(contents)
+    except Exception:
+        return None
+
+def _process_batch(uploads, method, intensity, inline=True):
+    """Anonymize a group of batch uploads, returning one result entry each
+    
+    `uploads` is a list of (filename, contents). Faces in the group are
+    detected with a single batched RetinaFace call. With `inline` each JPEG
+    is embedded as a base64 data URL, otherwise the raw bytes are returned
+    under `image_bytes` for the multipart response.
+    """
+    images = [_decode_upload(contents) for _, contents in uploads]
+    processed = iter(process_images([image for image in images if image is not None], method, intensity))
+    
+    results = []
+    for (filename, _), image in zip(uploads, images):
+        if image is None:
+            results.append({
+                "filename": filename,
+                "status": "error",
+                "error": "Invalid image"
+            })
+            continue
+        
+        processed_image, faces_count = next(processed)
+        buffer = encode_jpeg(processed_image)
+        result = {
+            "filename": filename,
+            "status": "success",
+            "faces_detected": faces_count
+        }
+        
+        if inline:
+            # Convert to a base64 data URL for response, built as bytes in one pass
+            result["image_data"] = (_DATA_URL_PREFIX + base64.b64encode(buffer)).decode('ascii')
+        else:
+            result["image_bytes"] = buffer
+        
+        results.append(result)
+    
+    return results
+
+def _multipart_parts(results, boundary):
+    """Yield a multipart/mixed body: one JPEG part per image, JSON for errors"""
+    for result in results:
+        if result["status"] == "success":
+            headers = (
+                "Content-Type: image/jpeg\r\n"
+                f"Content-Disposition: {content_disposition(result['filename'])}\r\n"
+                f"X-Faces-Detected: {result['faces_detected']}\r\n"
+            )
+            body = result["image_bytes"]
+        else:
+            headers = "Content-Type: application/json\r\n"
+            body = json.dumps(result).encode()
+        
+        yield f"--{boundary}\r\n{headers}\r\n".encode()
+        yield body
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
 @app.post("/api/anonymize/batch")
 async def anonymize_batch_endpoint(
     request: Request,
     files: List[UploadFile] = File(...),
     method: str = 'blur',
-    intensity: int = 51
+    intensity: int = 51,
+    inline: bool = True
 ):
-    """Anonymize faces in multiple images"""
+    """Anonymize faces in multiple images
+    
+    Returns JSON with base64 data URLs, or with `inline=false` a
+    multipart/mixed stream of the raw JPEGs.
+    """
     # Check rate limit (batch counts as 1 use)
     client_ip = request.client.host
-    if not check_rate_limit(client_ip):
-        usage = get_remaining_uses(client_ip)
+    if not await check_rate_limit(client_ip):
+        usage = await get_remaining_uses(client_ip)
         raise HTTPException(
             status_code=429,
             detail=f"Rate limit exceeded. You have used {usage['used']}/{usage['limit']} requests today."
@@ -347,55 +1152,50 @@ async def anonymize_batch_endpoint(
     if len(files) > 10:
         raise HTTPException(status_code=400, detail="Maximum 10 files per batch")
     
-    results = []
+    # Read every upload, then split the images across the pool workers so
+    # each worker detects its share with one batched call
+    results = [None] * len(files)
+    uploads = []
+    for index, file in enumerate(files):
+        # Validate file type
+        if not file.content_type.startswith('image/'):
+            results[index] = {
+                "filename": file.filename,
+                "status": "error",
+                "error": "Not an image file"
+            }
+        else:
+            uploads.append((index, file.filename, await file.read()))
     
-    for file in files:
+    async def _group(group):
         try:
-            # Validate file type
-            if not file.content_type.startswith('image/'):
-                results.append({
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": "Not an image file"
-                })
-                continue
-            
-            # Read and process image
-            contents = await file.read()
-            nparr = np.frombuffer(contents, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if image is None:
-                results.append({
-                    "filename": file.filename,
-                    "status": "error",
-                    "error": "Invalid image"
-                })
-                continue
-            
-            # Process image
-            processed_image, faces_count = process_image(image, method, intensity)
-            
-            # Convert to base64 for response
-            _, buffer = cv2.imencode('.jpg', processed_image)
-            import base64
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-            results.append({
-                "filename": file.filename,
-                "status": "success",
-                "faces_detected": faces_count,
-                "image_data": f"data:image/jpeg;base64,{img_base64}"
-            })
-        
+            entries = await run_in_pool(
+                _process_batch, [(filename, contents) for _, filename, contents in group],
+                method, intensity, inline
+            )
         except Exception as e:
-            results.append({
-                "filename": file.filename,
-                "status": "error",
-                "error": str(e)
-            })
+            entries = [
+                {"filename": filename, "status": "error", "error": str(e)}
+                for _, filename, _ in group
+            ]
+        for (index, _, _), entry in zip(group, entries):
+            results[index] = entry
+    
+    group_count = min(PROCESS_POOL_WORKERS, len(uploads))
+    await asyncio.gather(*[_group(uploads[i::group_count]) for i in range(group_count)])
     
-    usage = get_remaining_uses(client_ip)
+    usage = await get_remaining_uses(client_ip)
+    
+    if not inline:
+        boundary = uuid.uuid4().hex
+        return StreamingResponse(
+            _multipart_parts(results, boundary),
+            media_type=f"multipart/mixed; boundary={boundary}",
+            headers={
+                "X-Rate-Limit-Remaining": str(usage['remaining']),
+                "X-Rate-Limit-Used": str(usage['used'])
+            }
+        )
     
     return JSONResponse(content={
         "results": results,
@@ -404,4 +1204,12 @@ async def anonymize_batch_endpoint(
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    from dotenv import load_dotenv
+    # Settings from backend/.env (see .env.example); exported variables take
+    # precedence. They must be set before uvicorn imports main:app, and
+    # WEB_CONCURRENCY is re-read because this module already parsed it.
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+    uvicorn.run(
+        "main:app", host="0.0.0.0", port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "4"))
+    )
\ No newline at end of file
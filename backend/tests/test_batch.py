@@ -0,0 +1,29 @@
+import cv2
+import numpy as np
+
+import main
+
+
+def _jpeg(width=64, height=48):
+    image = np.full((height, width, 3), 128, dtype=np.uint8)
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+def test_bad_upload_only_fails_its_own_entry(monkeypatch):
+    # Keep the model out of the test: one face per decoded image
+    monkeypatch.setattr(main, 'detect_faces_batch', lambda images: [[(4, 4, 16, 16)] for _ in images])
+    
+    results = main._process_batch(
+        [('a.jpg', _jpeg()), ('empty.jpg', b''), ('junk.jpg', b'not an image'), ('b.jpg', _jpeg())],
+        'blur', 11, inline=False
+    )
+    
+    assert [r['filename'] for r in results] == ['a.jpg', 'empty.jpg', 'junk.jpg', 'b.jpg']
+    assert [r['status'] for r in results] == ['success', 'error', 'error', 'success']
+    assert results[0]['faces_detected'] == 1
+    assert results[3]['image_bytes'][:3] == b'\xff\xd8\xff'
+    assert results[1]['error'] == 'Invalid image'
+
+
+def test_decode_image_returns_none_for_empty_buffer():
+    assert main.decode_image(b'') is None